@@ -3,23 +3,45 @@
 # Асинхроность
 import asyncio
 import aiohttp
-import aiofiles
-import aiofiles.os
+
+try:
+    # uvloop недоступен в Windows, там остается стандартный цикл событий
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    # Асинхронное разрешение имен без обращения к пулу потоков
+    import aiodns
+except ImportError:
+    aiodns = None
 
 # Работа с каталогами
 from pathlib import Path
+from collections import OrderedDict
+from itertools import islice
 import shutil
-from hashlib import sha256
+import threading
+from hashlib import blake2b
+from urllib.parse import urljoin, urlsplit
 
 # Парсинг сайта
-from bs4 import BeautifulSoup, Tag
+import lxml.html
+from lxml.cssselect import CSSSelector
+from selectolax.lexbor import LexborHTMLParser, LexborNode
 import mimetypes
 
 # Журналирование
 import logging
+import logging.handlers
+import queue
+import atexit
 import sys
 
-from typing import Tuple, Generator
+from typing import Tuple, Generator, List, Dict, Optional, Set
+
+# Кэш расширений файлов по MIME-типу из заголовка Content-Type
+_EXT_CACHE: Dict[str, Optional[str]] = {}
 
 
 class Crawler:
@@ -29,15 +51,45 @@ class Crawler:
         """Инициализация."""
         # URL корневого узла
         self.top_url = "http://news.ycombinator.com"
+        # База для относительных ссылок на страницах сайта
+        self._base_url = self.top_url + "/"
+        # Варианты главной страницы, обходимые параллельно
+        self.index_urls = (
+            self.top_url,
+            self.top_url + "/newest",
+            self.top_url + "/show",
+        )
+        # ETag и Last-Modified последних ответов для каждого варианта
+        self._index_validators: Dict[str, Dict[str, str]] = {}
         # Задержка перед повторным обращением к сайту
         self.delay = 5
         # Количество новостей, попадающих в топ
         self.news_limit = 30
-        # Идентификаторы найденных новостей из топа
-        self.recent_news = set()
+        # Очередь новостей на загрузку и количество ее обработчиков. В очередь
+        # помещаются все новости одного опроса, поэтому опрос не ждет загрузок;
+        # ждать он будет, только если обработчики отстали больше чем на опрос
+        self.workers_count = 4
+        self._news_queue: asyncio.Queue[Tuple[int, str, Path]] = asyncio.Queue(
+            maxsize=len(self.index_urls) * self.news_limit
+        )
+        # Максимальное количество одновременных запросов к сайтам
+        self.concurrency_limit = 32
+        self.sem = asyncio.Semaphore(self.concurrency_limit)
+        # Размер блока при потоковой записи ответа в файл
+        self.chunk_size = 65536
+        # Идентификаторы найденных новостей из топа (LRU ограниченного размера,
+        # чтобы не расти бесконечно при долгой работе)
+        self.recent_news: OrderedDict[int, None] = OrderedDict()
+        self.recent_news_limit = 10000
+        # Страницы разбираются параллельно в разных потоках
+        self._recent_news_lock = threading.Lock()
         # Каталог для сохранения новостей (каталог data в корне проекта)
         self.current_directory = Path(__file__).parent.parent.parent.joinpath(
             "data")
+        # Селектор компилируется один раз, а не при каждом разборе страницы
+        self._comment_sel = CSSSelector("div.commtext a, div.c00 a")
+        # Общая HTTP-сессия на весь проход по сайту (создается в crawl)
+        self._session = None
 
     @staticmethod
     def get_file_extension_from_response(response) -> str:
@@ -47,9 +99,14 @@ class Crawler:
         :return: Расширение сохраняемого файла
         """
         content_type = response.headers.get("Content-Type", "text/html")
-        content_type = content_type.split(";")[0]
-        ext = mimetypes.guess_extension(content_type)
-        return ext
+        # Параметры (charset, boundary) отбрасываем, иначе кэш растет без предела
+        content_type = content_type.split(";")[0].strip().lower()
+        try:
+            return _EXT_CACHE[content_type]
+        except KeyError:
+            ext = mimetypes.guess_extension(content_type)
+            _EXT_CACHE[content_type] = ext
+            return ext
 
     def prepare_directory(self):
         """Очистка данных предыдущего запуска."""
@@ -59,25 +116,36 @@ class Crawler:
 
     def init_logger(self):
         """Инициализация журнала."""
-        logging.basicConfig(
-            level=logging.INFO,
-            filename=self.current_directory.joinpath("log.txt"),
-            filemode="w",
+        # Запись в файл выполняется в отдельном потоке, а цикл событий
+        # только помещает сообщения в очередь
+        log_queue = queue.Queue(-1)
+        file_handler = logging.FileHandler(
+            self.current_directory.joinpath("log.txt"), mode="w"
         )
+        file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        # Остаток очереди записывается при завершении программы
+        atexit.register(listener.stop)
+        root = logging.getLogger()
+        root.setLevel(logging.INFO)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
 
-    def find_link(self, articles: Tag) -> Tuple[str, str]:
+    def find_link(self, articles: LexborNode) -> Tuple[str, str]:
         """Находим название статьи и ссылку на нее.
 
         :arg articles - Распарсенный html-код
         :return: Название статьи, ссылка
         """
-        for span in articles.find_all("span", attrs={"class": "titleline"}):
-            for link in span.find_all("a"):
-                href = link["href"]
-                if href.startswith("item"):
-                    href = self.top_url + "/" + href
-                return link.string, href
-        return "", ""
+        link = articles.css_first("span.titleline a")
+        if link is None:
+            return "", ""
+        try:
+            href = urljoin(self._base_url, link.attributes.get("href") or "")
+        except ValueError:
+            # Некорректная ссылка: статью загрузить не получится
+            href = ""
+        return link.text(), href
 
     def get_news(self, html) -> Generator[Tuple[int, str, str], None, None]:
         """Находим новость.
@@ -85,21 +153,63 @@ class Crawler:
         :arg html - html-код
         :return: ID новости, название статьи, ссылка
         """
-        soup = BeautifulSoup(html, "lxml")
-        news_count = 0
-        for articles in soup.find_all("tr", attrs={"class": ["athing", "submission"]}):
-            news_count += 1
-            if news_count > self.news_limit:
-                raise StopIteration
-            news_id = int(articles["id"])
+        # Главная страница разбирается selectolax: структура ее простая,
+        # а узлы не превращаются в полноценное дерево объектов Python
+        tree = LexborHTMLParser(html)
+        # Локальные имена вместо поиска атрибутов на каждой итерации
+        _int = int
+        recent_news = self.recent_news
+        recent_news_limit = self.recent_news_limit
+        lock = self._recent_news_lock
+        find_link = self.find_link
+        # В топ попадают только первые news_limit новостей. Строки помечены
+        # классами "athing submission", а lexbor вернул бы строку для каждой
+        # группы селектора, поэтому выбираем только по одному классу
+        for articles in islice(tree.css("tr.athing"), self.news_limit):
+            news_id = _int(articles.attributes["id"])
             # Старые новости не нужны
-            if news_id not in self.recent_news:
-                self.recent_news.add(news_id)
-                descr, href = self.find_link(articles)
-                yield news_id, descr, href
+            with lock:
+                if news_id in recent_news:
+                    recent_news.move_to_end(news_id)
+                    continue
+                recent_news[news_id] = None
+                if len(recent_news) > recent_news_limit:
+                    recent_news.popitem(last=False)
+            descr, href = find_link(articles)
+            yield news_id, descr, href
 
-    @staticmethod
-    async def url_to_file(url, path, default_name=""):
+    async def response_to_file(self, response, full_path):
+        """Запись тела ответа в файл.
+
+        :arg response - ответ HTTP-сервера
+        :arg full_path - путь к файлу
+        """
+        length = response.content_length
+        # Для сжатого ответа Content-Length - размер до распаковки, поэтому
+        # такой ответ всегда пишем по частям
+        encoded = response.headers.get("Content-Encoding", "identity") != "identity"
+        if not encoded and length is not None and length <= self.chunk_size:
+            # Небольшой ответ записываем одним обращением к пулу потоков
+            data = await response.read()
+            await asyncio.to_thread(full_path.write_bytes, data)
+            return
+        # Большой ответ или ответ неизвестной длины пишем по частям,
+        # чтобы не держать его целиком в памяти. Пока загрузка не завершена,
+        # файл имеет временное имя
+        part_path = full_path.with_name(full_path.name + ".part")
+        f = await asyncio.to_thread(open, part_path, "wb")
+        try:
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            # Недокачанный файл не оставляем
+            f.close()
+            part_path.unlink(missing_ok=True)
+            raise
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(part_path.replace, full_path)
+
+    async def url_to_file(self, url, path, default_name=""):
         """Сохранение файла по URL в файл.
 
         :arg url - url-адрес
@@ -108,44 +218,64 @@ class Crawler:
         if default_name != "":
             filename = default_name
         else:
-            url_hash = sha256(url.encode()).hexdigest()[:50]
-            filename = f"{url_hash}"
+            # Криптостойкость не нужна: хэш служит только именем файла
+            filename = blake2b(url.encode(), digest_size=20).hexdigest()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        ext = Crawler.get_file_extension_from_response(response)
-                        if ext is not None:
-                            filename += ext
-                        full_path = path.joinpath(filename)
-                        async with aiofiles.open(full_path, "wb") as f:
-                            await f.write(await response.read())
-                        if default_name == "":
-                            logging.info("COMMENT URL:" + url)
-                            logging.info("COMMENT PATH:" + str(full_path))
+            async with self.sem, self._session.get(url) as response:
+                if response.status == 200:
+                    ext = self.get_file_extension_from_response(response)
+                    if ext is not None:
+                        filename += ext
+                    full_path = path.joinpath(filename)
+                    await self.response_to_file(response, full_path)
+                    if default_name == "":
+                        logging.info("COMMENT URL:%s", url)
+                        logging.info("COMMENT PATH:%s", full_path)
         except (
             aiohttp.client_exceptions.ClientConnectorError,
             aiohttp.client_exceptions.ConnectionTimeoutError,
             aiohttp.client_exceptions.ClientOSError,
             aiohttp.client_exceptions.ClientPayloadError,
+            aiohttp.client_exceptions.InvalidURL,
             asyncio.TimeoutError,
         ) as e:
             logging.error(e)
 
+    def _extract_comment_links(self, html) -> Set[str]:
+        """Извлечение ссылок из комментариев.
+
+        :arg html - код страницы
+        :return: Множество ссылок без повторов
+        """
+        root = lxml.html.fromstring(html)
+        links = set()
+        for link in self._comment_sel(root):
+            href = link.get("href")
+            if href is None:
+                continue
+            try:
+                url = urljoin(self._base_url, href)
+                scheme = urlsplit(url).scheme
+            except ValueError:
+                # Некорректная ссылка, например "http://[::1"
+                continue
+            # Ссылки mailto: и им подобные не загружаются
+            if scheme in ("http", "https"):
+                links.add(url)
+        return links
+
     async def parse_comments_page(self, html, path):
         """Парсинг страницы с комментариями.
 
         :arg html - код страницы
         :arg path - путь к каталогу с файлами
         """
-        soup = BeautifulSoup(html, "lxml")
+        # Разбор выполняется в отдельном потоке, чтобы не блокировать
+        # цикл событий и не задерживать идущие параллельно загрузки
+        links = await asyncio.to_thread(self._extract_comment_links, html)
         async with asyncio.TaskGroup() as tg:
-            for comment in soup.find_all("div", attrs={"class": ["commtext", "c00"]}):
-                for link in comment.find_all("a"):
-                    href = link["href"]
-                    if href.startswith("item"):
-                        href = self.top_url + "/" + href
-                    tg.create_task(self.url_to_file(href, path))
+            for href in links:
+                tg.create_task(self.url_to_file(href, path))
 
     async def load_comments(self, news_id, path):
         """Загрузка страницы с комментариями.
@@ -155,13 +285,14 @@ class Crawler:
         """
         url = self.top_url + "/item?id=" + str(news_id)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        return
-                    html = await response.text()
-                    # Извлекаем ссылки из комментариев
-                    await self.parse_comments_page(html, path)
+            # Семафор удерживается только на время загрузки страницы,
+            # иначе дочерние задачи url_to_file могут не дождаться его
+            async with self.sem, self._session.get(url) as response:
+                if response.status != 200:
+                    return
+                html = await response.text()
+            # Извлекаем ссылки из комментариев
+            await self.parse_comments_page(html, path)
         except (
             aiohttp.client_exceptions.ClientConnectorError,
             aiohttp.client_exceptions.ConnectionTimeoutError,
@@ -171,31 +302,78 @@ class Crawler:
         ) as e:
             logging.error(e)
 
+    @staticmethod
+    def _make_directories(paths: List[Path]):
+        """Создание каталогов.
+
+        :arg paths - пути к каталогам
+        """
+        for path in paths:
+            # Вытесненная из LRU новость может вернуться в топ
+            path.mkdir(exist_ok=True)
+
     async def parse_index_page(self, html):
         """Парсинг главной страницы.
 
         :arg html - код страницы
         """
-        async with asyncio.TaskGroup() as tg:
-            for news_id, news_text, news_href in self.get_news(html):
-                news_path = self.current_directory.joinpath(str(news_id))
-                # Каталог для сохранения
-                await aiofiles.os.mkdir(news_path)
-                logging.info("NEWS ID:" + str(news_id))
-                logging.info("NEWS TEXT:" + news_text)
-                logging.info("NEWS URL:" + news_href)
+        # Разбор страницы в отдельном потоке
+        news = await asyncio.to_thread(list, self.get_news(html))
+        paths = [
+            self.current_directory.joinpath(str(news_id)) for news_id, _, _ in news
+        ]
+        # Каталоги для сохранения создаем за одно обращение к пулу потоков
+        await asyncio.to_thread(self._make_directories, paths)
+        for (news_id, news_text, news_href), news_path in zip(news, paths):
+            logging.info("NEWS ID:%s", news_id)
+            logging.info("NEWS TEXT:%s", news_text)
+            logging.info("NEWS URL:%s", news_href)
+            # Загрузкой занимаются обработчики очереди
+            await self._news_queue.put((news_id, news_href, news_path))
+
+    async def news_worker(self):
+        """Обработчик очереди новостей."""
+        while True:
+            news_id, news_href, news_path = await self._news_queue.get()
+            async with asyncio.TaskGroup() as tg:
                 tg.create_task(self.load_comments(news_id, news_path))
                 tg.create_task(self.url_to_file(news_href, news_path, "index"))
 
-    async def iteration(self):
-        """Однократный проход по сайту."""
+    async def poll(self):
+        """Периодический опрос главной страницы и ее вариантов."""
+        iteration = 0
+        while True:
+            iteration += 1
+            logging.info("Iteration #%s", iteration)
+            await asyncio.gather(*(self.iteration(url) for url in self.index_urls))
+            await asyncio.sleep(self.delay)
+
+    async def iteration(self, url):
+        """Однократный проход по странице сайта.
+
+        :arg url - адрес главной страницы или ее варианта
+        """
         html = ""
+        # Условный запрос: если страница не менялась, сервер ответит 304
+        validators = self._index_validators.get(url, {})
+        headers = {}
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.top_url) as response:
-                    if response.status != 200:
-                        return
-                    html = await response.text()
+            async with self._session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    logging.info("NOT MODIFIED:%s", url)
+                    return
+                if response.status != 200:
+                    return
+                html = await response.text()
+                self._index_validators[url] = {
+                    name: response.headers[name]
+                    for name in ("ETag", "Last-Modified")
+                    if name in response.headers
+                }
             # Извлекаем новости
             await self.parse_index_page(html)
         # await process_news(session, page_content)
@@ -213,12 +391,23 @@ class Crawler:
         """Многократный проход по сайту."""
         self.prepare_directory()
         self.init_logger()
-        iteration = 0
-        while True:
-            iteration += 1
-            logging.info("Iteration #" + str(iteration))
-            await self.iteration()
-            await asyncio.sleep(self.delay)
+        resolver = aiohttp.AsyncResolver() if aiodns is not None else None
+        connector = aiohttp.TCPConnector(
+            resolver=resolver,
+            use_dns_cache=True,
+            limit=self.concurrency_limit,
+            limit_per_host=20,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        # Одна сессия на все запросы: соединения с сайтом переиспользуются
+        async with aiohttp.ClientSession(connector=connector) as self._session:
+            # Опрос сайта не ждет окончания загрузок: новости передаются
+            # через очередь обработчикам
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(self.workers_count):
+                    tg.create_task(self.news_worker())
+                tg.create_task(self.poll())
 
 
 async def main():
@@ -229,8 +418,10 @@ async def main():
 
 if __name__ == "__main__":
     print("Crawler started")
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         logging.info("Closing crawler")
         sys.exit(0)